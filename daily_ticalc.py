@@ -43,20 +43,31 @@ if dhistory == None or indicators == None:
 # get list of stocks in the universe
 if cmdline.source == 'yahoo':
     query = "select distinct value d.ticker from daily d"
-    stocklist = ol.qrycosdb(dhistory, query)
+    try:
+        stocklist = list(ol.qrycosdb(dhistory, query))
+    except Exception:
+        logging.error('Could not get the list of stocks.', exc_info=True)
+        quit()
 else:
     query = "SELECT DISTINCT ticker FROM stockdata..ohlcv_day"
     t = ol.qrysqldb(dhistory, query)
     stocklist = t.fetchall()
 
+# CosmosDB queries used for each stock; the ticker is passed as a parameter
+historyqry = "SELECT d.id, d.ticker, d.tradedate, d.high as h, d.low as l, d.open as o, d.adjclose as c, d.volume as v FROM daily d where d.ticker = @ticker"
+maxdateqry = "SELECT VALUE max(d.tradedate) from daily d where d.ticker = @ticker"
+
 # process the daily stocks
 for stock in stocklist:
 
 # Get all the daily data for the past 180 days for the given stock
 # Note: 4.88 RU per 100 rows
     if cmdline.source == 'yahoo':
-        query = "SELECT d.id, d.ticker, d.tradedate, d.high as h, d.low as l, d.open as o, d.adjclose as c, d.volume as v FROM daily d where d.ticker = '" + stock + "'"
-        df=pd.DataFrame(ol.qrycosdb(dhistory, query))
+        try:
+            df=pd.DataFrame(list(ol.qrycosdb(dhistory, historyqry, params=[{'name': '@ticker', 'value': stock}])))
+        except Exception:
+            logging.error('Could not get the history for ' + stock + '; it is being skipped.', exc_info=True)
+            df = pd.DataFrame()
     else:
         query = "SELECT ticker, tradedate, h, l, o, c, v FROM stockdata..ohlcv_day where ticker = '" + stock[0] + "'"
         df = pd.read_sql_query(query, indicators)
@@ -67,8 +78,7 @@ for stock in stocklist:
         dt = parse('1971-01-01')
         dt_str = dt.strftime('%Y-%m-%d')
         if cmdline.source == 'yahoo':
-            query = "SELECT VALUE max(d.tradedate) from daily d where d.ticker = '" + stock + "'"
-            dt_list = ol.qrycosdb(indicators, query)
+            dt_list = ol.qrycosdb(indicators, maxdateqry, params=[{'name': '@ticker', 'value': stock}])
             # NEED TO CREATE A LIST FROM COSMOSDB
         else:
             dt=[]
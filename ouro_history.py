@@ -123,6 +123,7 @@ for x in slist:
                 data = ol.GetOHLCV(ticker=x, startdate=startdate_str, enddate=today_str, timeframe='1D')
             except Exception as ex:
                 logging.warning ('Data for ' + x + ' has problems; it is being skipped.', exc_info=True)
+                data = pd.DataFrame()
 
             if not data.empty:
                 try:
@@ -172,6 +173,7 @@ for x in slist:
                 data = ol.GetOHLCV(ticker=x, startdate=startdate_str, enddate=today_str, timeframe='1Min')
             except Exception as ex:
                 logging.warning ('Minute-data for ' + x + ' has problems; it is being skipped.', exc_info=True)
+                data = pd.DataFrame()
 
             # Write the data
             if not data.empty:
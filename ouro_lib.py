@@ -7,6 +7,7 @@
 import os                               # for operating system specific functions
 import logging                          # for application logging
 import json                             # for manipulating array data
+import numpy as np                      # vectorized array math
 import pandas as pd                     # in-memory database capabilities
 import talib as ta                      # lib to calcualted technical indicators
 from azure.cosmos import exceptions, CosmosClient, PartitionKey
@@ -14,30 +15,88 @@ import alpaca_trade_api as tradeapi     # required for interaction with Alpaca
 from datetime import datetime
 from datetime import timedelta
 import time
+import random
+import threading
+import asyncio
 from dateutil.parser import parse
 import pyodbc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from functools import partial, lru_cache
+try:
+    import polars as pl                 # optional engine for calcind; see OURO_ENGINE
+except ImportError:
+    pl = None
+try:
+    from numba import njit, prange      # optional JIT for calcind's votes
+except ImportError:
+    njit = None
+
+# Minimum number of bars before calcind spreads the TA-Lib calls across threads
+TA_THREAD_MIN_ROWS = 2000
+
+# Indicators that must be present for a row to vote, and the votes that make up a STRATEGY_ID (in order)
+VOTE_INPUTS = ['AROONUP', 'AROONDN', 'BOP', 'CCI14', 'CMO14', 'MACDHIST', 'PPO12', 'RSI14', 'STOCHK', 'STOCHD',
+               'STOCHRSIK', 'STOCHRSID', 'ADOSC']
+VOTE_COLS = ['AROONVOTE', 'BOPVOTE', 'CCIVOTE', 'CMOVOTE', 'MACDVOTE', 'PPOVOTE', 'RSIVOTE', 'STOCHVOTE',
+             'STOCHRSIVOTE', 'TRIXVOTE', 'ADOSCVOTE']
+
+# ADX trend strength bands
+TREND_BINS = [-np.inf, 25, 50, 75, np.inf]
+TREND_LABELS = ['Weak', 'Changing', 'Strong', 'Very Strong']
+
+# Let the ODBC driver manager pool connections; must be set before the first connect
+# Note:  Each sqldbconn / sqldbcursor call gets its own connection; closed connections go back to the pool
+pyodbc.pooling = True
+
+# Shared CosmosDB client
+_COS_CLIENT = None
+
+# Shared Alpaca client and the last market clock it returned
+_ALPACA = None
+_CLOCK = None
+_CLOCK_TIME = 0
+CLOCK_TTL = 5   # seconds a market clock is reused before asking Alpaca again
+
+# Last Alpaca account response
+_ACCOUNT = None
+_ACCOUNT_TIME = 0
+ACCOUNT_TTL = 60    # seconds account details (cash, buying power) are reused
+
+# Symbols with a held position, kept current by the trade updates stream once StartTradeUpdates is called
+_HELD = None
+_HELD_LOCK = threading.Lock()
+_HELD_TIME = 0
+_STREAM_THREAD = None
+HELD_RESYNC = 300   # seconds before the tracked positions are checked against Alpaca again
+
+# Attempts GetOHLCV makes to get a barset before giving up
+BARSET_TRIES = 6
+
+def _sqlconnect(usr, pwd, tries=5):
+    # connect to the Ouro SQL Server DSN, backing off between failed attempts (0.1s doubling up to 5s)
+    sqluser = os.environ.get("OURO_SQL_USER", usr)
+    sqlpwd = os.environ.get("OURO_SQL_PWD", pwd)
+    delay = 0.1
+    for attempt in range(1, tries + 1):
+        try:
+            return pyodbc.connect('DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd, autocommit=True)
+        except pyodbc.Error:
+            logging.warning('Could not connect to SQL Server; attempt ' + str(attempt) + ' of ' + str(tries), exc_info=True)
+            if attempt < tries:
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+    return None
 
 def sqldbconn (dsn='ouro_dsn', usr='unknown', pwd='unknown'):
     # connect to a SQL server DSN
-    sqluser = sqlpwd=os.environ.get("OURO_SQL_USER", usr)
-    sqlpwd=os.environ.get("OURO_SQL_PWD", pwd)
-    pyodbc.autocommit = True
-    try:
-        sqlsvr = pyodbc.connect('DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd, autocommit=True)
-        return sqlsvr
-    except:
-        return None
+    return _sqlconnect(usr, pwd)
 
 def sqldbcursor (dsn='ouro_dsn', usr='unknown', pwd='unknown'):
-    # connect to a SQL server DSN
-    sqluser = sqlpwd=os.environ.get("OURO_SQL_USER", usr)
-    sqlpwd=os.environ.get("OURO_SQL_PWD", pwd)
-    pyodbc.autocommit = True
-    try:
-        sqlsvr = pyodbc.connect('DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd, autocommit=True)
-        return sqlsvr.cursor()
-    except:
+    # get a cursor on a new SQL server connection
+    sqlsvr = _sqlconnect(usr, pwd)
+    if sqlsvr is None:
         return None
+    return sqlsvr.cursor()
 
 def qrysqldb(csr, query):
     # Execute a query against a connection to a SQL database
@@ -49,6 +108,13 @@ def qrysqldb(csr, query):
         print(ex)
         return None
 
+def _cosclient(endpoint, key):
+    # Create the CosmosDB client once; every container shares its HTTP pipeline and kept-alive connections
+    global _COS_CLIENT
+    if _COS_CLIENT is None:
+        _COS_CLIENT = CosmosClient(endpoint, key)
+    return _COS_CLIENT
+
 def cosdb (db, ctr, prtn):
     # Connect to a CosmosDB database and container
 
@@ -58,7 +124,7 @@ def cosdb (db, ctr, prtn):
     # Initialize the Cosmos client
     endpoint = os.environ.get("OURO_DOCUMENTS_ENDPOINT", "SET OURO_DOCUMENTS_ENDPOINT IN ENVIRONMENT")
     key = os.environ.get("OURO_DOCUMENTS_KEY", "SET OURO_DOCUMENTS_KEY IN ENVIRONMENT")
-    client = CosmosClient(endpoint, key)
+    client = _cosclient(endpoint, key)
     database = client.create_database_if_not_exists(id=db)
 
     # Connect to the daily_indicators container
@@ -75,21 +141,133 @@ def cosdb (db, ctr, prtn):
         logging.critical(ex)
         quit(-1)
 
-def qrycosdb(ctr, query):
+def qrycosdb(ctr, query, params=None, batch_size=1000):
     # Execute a query against a connection to a CosmosDB container
-    try:
-        ds = list(ctr.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        logging.debug('Running query:  ' + query)
-        return ds
-    except Exception as ex:
-        logging.debug('Query did not return results:  ' + query)
-        logging.debug(ex)
-        return None
+    # Note 1:  This returns an iterator that fetches pages of batch_size items as it's read; use list() when
+    #          the whole result is needed at once
+    # Note 2:  Pass values as params, e.g. [{'name': '@ticker', 'value': 'CVS'}], instead of building them into
+    #          the query text so the same query is reused
+    # Note 3:  Nothing is sent until the iterator is read, so query errors are raised there; callers handle them
+    logging.debug('Running query:  ' + query)
+    return ctr.query_items(
+        query=query,
+        parameters=params,
+        enable_cross_partition_query=True,
+        max_item_count=batch_size
+    )
+
+def _calcta(o, h, l, c, v, compute_all=True):
+    # Run the TA-Lib indicators for calcind over contiguous float64 OHLCV arrays
+    # Returns {column name: values} in the order the columns should be added
+
+    # Each job is the column name (or names, for multi-output indicators) and the TA-Lib call that fills it
+    jobs = [
+        # Momentum indicators
+        ('ADX14', partial(ta.ADX, h, l, c)),
+        ('ADXR14', partial(ta.ADXR, h, l, c)),
+        (('AROONUP', 'AROONDN'), partial(ta.AROON, h, l, timeperiod=14)),
+        ('BOP', partial(ta.BOP, o, h, l, c)),
+        ('CCI14', partial(ta.CCI, h, l, c, timeperiod=14)),
+        ('CMO14', partial(ta.CMO, c, timeperiod=14)),
+        (('MACD', 'MACDSIG', 'MACDHIST'), partial(ta.MACD, c, fastperiod=12, slowperiod=26, signalperiod=9)),
+        ('PPO12', partial(ta.PPO, c, fastperiod=12, slowperiod=26, matype=0)),
+        ('RSI14', partial(ta.RSI, c, timeperiod=14)),
+        (('STOCHK', 'STOCHD'), partial(ta.STOCH, h, l, c, fastk_period=5, slowk_period=3, slowk_matype=0, slowd_period=3, slowd_matype=0)),
+        (('STOCHRSIK', 'STOCHRSID'), partial(ta.STOCHRSI, c, timeperiod=14, fastk_period=5, fastd_period=3, fastd_matype=0)),
+        ('TRIX30', partial(ta.TRIX, c, timeperiod=30)),
+
+        # Volume Indicators
+        ('ADOSC', partial(ta.ADOSC, h, l, c, v, fastperiod=3, slowperiod=10)),
+
+        # Candlestick Patterns; these are the must-buy patterns pathfinder checks
+        ('ENG', partial(ta.CDLENGULFING, o, h, l, c)),
+        ('MSR', partial(ta.CDLMORNINGSTAR, o, h, l, c, penetration=0)),
+        ('KKR', partial(ta.CDLKICKING, o, h, l, c)),
+    ]
+
+    if compute_all:
+        jobs += [
+            # Momentum indicators that don't vote
+            ('APO12', partial(ta.APO, c, fastperiod=12, slowperiod=26, matype=0)),
+            ('DX14', partial(ta.DX, h, l, c, timeperiod=14)),
+            ('MFI4', partial(ta.MFI, h, l, c, v, timeperiod=14)),
+            ('MOM10', partial(ta.MOM, c, timeperiod=10)),
+            ('ROC10', partial(ta.ROC, c, timeperiod=10)),
+            ('ULTOSC', partial(ta.ULTOSC, h, l, c, timeperiod1=7, timeperiod2=14, timeperiod3=28)),
+
+            # Moving Average or Overlap functions
+            (('BBUPPER', 'BBMID', 'BBLOWER'), partial(ta.BBANDS, c, timeperiod=5, nbdevup=2, nbdevdn=2, matype=0)),
+            ('EMA14', partial(ta.EMA, c, timeperiod=14)),
+            ('SMA14', partial(ta.SMA, c, timeperiod=14)),
+
+            # Volume Indicators that don't vote
+            ('AD', partial(ta.AD, h, l, c, v)),
+            ('OBV', partial(ta.OBV, c, v)),
+
+            # Remaining Candlestick Patterns
+            ('DJI', partial(ta.CDLDOJI, o, h, l, c)),
+            ('HMR', partial(ta.CDLHAMMER, o, h, l, c)),
+            ('HGM', partial(ta.CDLHANGINGMAN, o, h, l, c)),
+            ('PRC', partial(ta.CDLPIERCING, o, h, l, c)),
+            ('DCC', partial(ta.CDLDARKCLOUDCOVER, o, h, l, c, penetration=0)),
+            ('ESR', partial(ta.CDLEVENINGSTAR, o, h, l, c, penetration=0)),
+            ('SSR', partial(ta.CDLSHOOTINGSTAR, o, h, l, c)),
+            ('IHM', partial(ta.CDLINVERTEDHAMMER, o, h, l, c)),
+            ('TWS', partial(ta.CDL3WHITESOLDIERS, o, h, l, c)),
+            ('TBC', partial(ta.CDL3BLACKCROWS, o, h, l, c)),
+            ('STP', partial(ta.CDLSPINNINGTOP, o, h, l, c)),
+        ]
+
+    # The indicators only read the shared arrays, so long histories run them across threads;
+    # short frames (e.g. pathfinder's 42 minutes) run them in order to skip the pool overhead
+    if len(c) >= TA_THREAD_MIN_ROWS:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            futures = [(names, ex.submit(fn)) for names, fn in jobs]
+            results = [(names, fut.result()) for names, fut in futures]
+    else:
+        results = [(names, fn()) for names, fn in jobs]
 
-def calcind(df):
+    columns = {}
+    for names, result in results:
+        if isinstance(names, tuple):
+            columns.update(zip(names, result))
+        else:
+            columns[names] = result
+    return columns
+
+if njit is not None:
+    @njit(cache=True)
+    def _vote(buy, sell):
+        if buy:
+            return 1
+        if sell:
+            return -1
+        return 0
+
+    @njit(parallel=True, cache=True)
+    def _votes_kernel(aroonosc, bop, cci, cmo, macdhist, rsi, stochk, stochd, stochrsik, stochrsid, trix, adosc):
+        # Compiled version of calcind's votes; one parallel pass over the rows with the same thresholds
+        # Returns an (n, 11) int8 matrix with the votes in VOTE_COLS order
+        n = bop.shape[0]
+        votes = np.zeros((n, 11), dtype=np.int8)
+        for i in prange(n):
+            nextmacd = macdhist[i + 1] if i + 1 < n else np.nan
+            votes[i, 0] = _vote(aroonosc[i] >= 25, aroonosc[i] <= -25)
+            votes[i, 1] = _vote(bop[i] > 0, bop[i] < 0)
+            votes[i, 2] = _vote(cci[i] >= 100, cci[i] <= -100)
+            votes[i, 3] = _vote(cmo[i] < -50, cmo[i] > 50)
+            votes[i, 4] = _vote(macdhist[i] > 0 and nextmacd < macdhist[i], macdhist[i] < 0 and nextmacd > macdhist[i])
+            # votes[i, 5] is PPO, which doesn't vote
+            votes[i, 6] = _vote(rsi[i] <= 30, rsi[i] >= 70)
+            votes[i, 7] = _vote(stochk[i] <= 20 and stochd[i] <= 20, stochk[i] >= 80 and stochd[i] >= 80)
+            votes[i, 8] = _vote(stochrsik[i] <= 20 and stochrsid[i] <= 20, stochrsik[i] >= 80 and stochrsid[i] >= 80)
+            votes[i, 9] = _vote(trix[i] > 0, trix[i] < 0)
+            votes[i, 10] = _vote(adosc[i] > 0, adosc[i] < 0)
+        return votes
+else:
+    _votes_kernel = None
+
+def calcind(df, compute_all=True):
     # Calculate indicators and interpret them into buy or sell signals
     # Note 1:  If the dataframe is not sorted in timeframe order, the results will be worthless
     # Note 2:  The dataframe must have the following OHLCV attributes at a minimum:
@@ -100,162 +278,208 @@ def calcind(df):
     #       "c": 110            <-- close value
     #       "v": 3000           <-- volume value
     #   }
+    # Note 3:  Set compute_all to False when only the votes and STRATEGY_ID are needed; the indicators
+    #          that don't feed a vote (and the candlesticks other than KKR, ENG and MSR) are skipped.
+    # Note 4:  Set OURO_ENGINE=polars in the environment to run calcind_polars instead (requires polars)
+
+    if not df.empty and os.environ.get("OURO_ENGINE", "pandas") == 'polars' and pl is not None:
+        # Only the OHLCV columns go through polars; every row comes back, so the results are put on the caller's
+        # frame by position and the rows that can't vote are dropped the same way as below
+        out = calcind_polars(pl.from_pandas(df[['o', 'h', 'l', 'c', 'v']]).lazy(), compute_all, dropna=False)
+        out = out.drop(['o', 'h', 'l', 'c', 'v']).to_pandas()
+        for name in out.columns:
+            df[name] = out[name].to_numpy()
+        for name in ['ADXTREND', 'ADXRTREND']:
+            df[name] = pd.Categorical(df[name], categories=TREND_LABELS, ordered=True)
+        df.dropna(subset=VOTE_INPUTS, inplace=True)
+        return df
 
     if not df.empty:
         # calculate the technical indicators if there is data to do so
         # Ref:  https://mrjbq7.github.io/ta-lib/func_groups/momentum_indicators.html
 
-        # Momentum indicators
-        df['ADX14'] = ta.ADX(df['h'], df['l'], df['c'])
-        df['ADXR14'] = ta.ADXR(df['h'], df['l'], df['c'])
-        df['APO12'] = ta.APO(df['c'], fastperiod=12, slowperiod=26, matype=0)
-        df['AROONUP'], df['AROONDN'] = ta.AROON(df['h'], df['l'], timeperiod=14)
-        df['BOP'] = ta.BOP(df['o'], df['h'], df['l'], df['c'])
-        df['CCI14'] = ta.CCI(df['h'], df['l'], df['c'], timeperiod=14)
-        df['CMO14'] = ta.CMO(df['c'], timeperiod=14)
-        df['DX14'] = ta.DX(df['h'], df['l'], df['c'], timeperiod=14)
-        df['MACD'], df['MACDSIG'], df['MACDHIST'] = ta.MACD(df['c'], fastperiod=12, slowperiod=26, signalperiod=9)
-        df['MFI4'] = ta.MFI(df['h'], df['l'], df['c'], df['v'], timeperiod=14)
-        df['MOM10'] = ta.MOM(df['c'], timeperiod=10)
-        df['PPO12'] = ta.PPO(df['c'], fastperiod=12, slowperiod=26, matype=0)
-        df['ROC10'] = ta.MOM(df['c'], timeperiod=10)
-        df['RSI14'] = ta.RSI(df['c'], timeperiod=14)
-        df['STOCHK'], df['STOCHD'] = ta.STOCH(df['h'], df['l'], df['c'], fastk_period=5, slowk_period=3, slowk_matype=0, slowd_period=3, slowd_matype=0)
-        df['STOCHRSIK'], df['STOCHRSID'] = ta.STOCHRSI(df['c'], timeperiod=14, fastk_period=5, fastd_period=3, fastd_matype=0)
-        df['TRIX30'] = ta.TRIX(df['c'], timeperiod=30)
-        df['ULTOSC'] = ta.ULTOSC(df['h'], df['l'], df['c'], timeperiod1=7, timeperiod2=14, timeperiod3=28)
-
-        # Moving Average or Overlap functions
-        df['BBUPPER'], df['BBMID'], df['BBLOWER'] = ta.BBANDS(df['c'], timeperiod=5, nbdevup=2, nbdevdn=2, matype=0)
-        df['EMA14'] = ta.EMA(df['c'], timeperiod=14)
-        df['SMA14'] = ta.SMA(df['c'], timeperiod=14)
+        # Pull contiguous float64 arrays once; TA-Lib works directly on these without converting each Series
+        o = np.ascontiguousarray(df['o'].values, dtype=np.float64)
+        h = np.ascontiguousarray(df['h'].values, dtype=np.float64)
+        l = np.ascontiguousarray(df['l'].values, dtype=np.float64)
+        c = np.ascontiguousarray(df['c'].values, dtype=np.float64)
+        v = np.ascontiguousarray(df['v'].values, dtype=np.float64)
 
-        # Volume Indicators
-        df['AD'] = ta.AD(df['h'], df['l'], df['c'], df['v'])
-        df['ADOSC'] = ta.ADOSC(df['h'], df['l'], df['c'], df['v'], fastperiod=3, slowperiod=10)
-        df['OBV'] = ta.OBV(df['c'], df['v'])
-
-        # Candlestick Patterns
-        df['DJI'] = ta.CDLDOJI (df['o'], df['h'], df['l'], df['c'])
-        df['ENG'] = ta.CDLENGULFING (df['o'], df['h'], df['l'], df['c'])
-        df['HMR'] = ta.CDLHAMMER (df['o'], df['h'], df['l'], df['c'])
-        df['HGM'] = ta.CDLHANGINGMAN (df['o'], df['h'], df['l'], df['c'])
-        df['PRC'] = ta.CDLPIERCING (df['o'], df['h'], df['l'], df['c'])
-        df['DCC'] = ta.CDLDARKCLOUDCOVER (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['MSR'] = ta.CDLMORNINGSTAR (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['ESR'] = ta.CDLEVENINGSTAR (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['KKR'] = ta.CDLKICKING (df['o'], df['h'], df['l'], df['c'])
-        df['SSR'] = ta.CDLSHOOTINGSTAR (df['o'], df['h'], df['l'], df['c'])
-        df['IHM'] = ta.CDLINVERTEDHAMMER (df['o'], df['h'], df['l'], df['c'])
-        df['TWS'] = ta.CDL3WHITESOLDIERS (df['o'], df['h'], df['l'], df['c'])
-        df['TBC'] = ta.CDL3BLACKCROWS (df['o'], df['h'], df['l'], df['c'])
-        df['STP'] = ta.CDLSPINNINGTOP (df['o'], df['h'], df['l'], df['c'])
+        indicators = _calcta(o, h, l, c, v, compute_all)
+        for name, values in indicators.items():
+            df[name] = values
 
         # ADX Trend Strength
-        df['ADXTREND'] = 'Weak'
-        df.loc[df['ADX14'] >= 25, 'ADXTREND'] = 'Changing'
-        df.loc[df['ADX14'] >= 50, 'ADXTREND'] = 'Strong'
-        df.loc[df['ADX14'] >= 75, 'ADXTREND'] = 'Very Strong'
+        df['ADXTREND'] = pd.Series(pd.cut(df['ADX14'].to_numpy(), TREND_BINS, right=False, labels=TREND_LABELS),
+                                   index=df.index).fillna('Weak')
 
         # ADXR Trend Strength
-        df['ADXRTREND'] = 'Weak'
-        df.loc[df['ADXR14'] >= 25, 'ADXRTREND'] = 'Changing'
-        df.loc[df['ADXR14'] >= 50, 'ADXRTREND'] = 'Strong'
-        df.loc[df['ADXR14'] >= 75, 'ADXRTREND'] = 'Very Strong'
+        df['ADXRTREND'] = pd.Series(pd.cut(df['ADXR14'].to_numpy(), TREND_BINS, right=False, labels=TREND_LABELS),
+                                    index=df.index).fillna('Weak')
 
         # AROON Oscillator
         df['AROONOSC'] = df['AROONDN'] - df['AROONUP']
-        df['AROONVOTE'] = 0
-        df.loc[df['AROONOSC'] >= 25, 'AROONVOTE'] = 1    # This threshold is a guess
-        df.loc[df['AROONOSC'] <= -25, 'AROONVOTE'] = -1  # This threshold is a guess
-
-
-
-        # BOP Signal
-        df['BOPVOTE'] = 0
-        df.loc[(df['BOP'] >0), 'BOPVOTE'] = 1
-        df.loc[(df['BOP'] <0), 'BOPVOTE'] = -1
-
-        # CCI Vote
-        df['CCIVOTE'] = 0
-        df.loc[df['CCI14'] >= 100, 'CCIVOTE'] = 1
-        df.loc[df['CCI14'] <= -100, 'CCIVOTE'] = -1
-
-        # CMO Votes
-        df['CMOVOTE'] = 0
-        df.loc[df['CMO14'] < -50, 'CMOVOTE'] = 1
-        df.loc[df['CMO14'] > 50, 'CMOVOTE'] = -1
-
-        # MACD Vote; based on when the histogram crosses the zero line
-        df['MACDVOTE'] = 0
-        df.loc[(df['MACDHIST'] > 0) & (df['MACDHIST'].shift(periods=-1) < df['MACDHIST']), 'MACDVOTE'] = 1
-        df.loc[(df['MACDHIST'] < 0) & (df['MACDHIST'].shift(periods=-1) > df['MACDHIST']), 'MACDVOTE'] = -1
-        df.loc[df['MACDHIST'] == 0, 'MACDVOTE'] = 0
-
-        # MFI Votes
-        # Skipping interpretting MFI because it correlates to the direction of price
-
-        # MOM Votes
-        # Skipping basic momentum because it's not a good signal for buy or sell
-
-        # PPO Votes; cousin of MACD
-        df['PPOVOTE'] = 0
-        #df.loc[df['PPO12'] >= 0, 'RSIVOTE'] = 1
-        #df.loc[df['PPO12'] <= 0, 'RSIVOTE'] = -1
-
-        # ROC Votes
-        # Not using ROC because it's prone to whipsaws near the 0 line; and, this isn't used to trade
 
-        # RSI Votes
-        df['RSIVOTE'] = 0
-        df.loc[df['RSI14'] >= 70, 'RSIVOTE'] = -1
-        df.loc[df['RSI14'] <= 30, 'RSIVOTE'] = 1
-
-        # STOCH Votes
-        df['STOCHVOTE'] = 0
-        df.loc[(df['STOCHK'] >= 80) & (df['STOCHD'] >= 80), 'STOCHVOTE'] = -1
-        df.loc[(df['STOCHK'] <= 20) & (df['STOCHD'] <= 20), 'STOCHVOTE'] = 1
-
-        # STOCHRSI Votes
-        df['STOCHRSIVOTE'] = 0
-        df.loc[(df['STOCHRSIK'] >= 80) & (df['STOCHRSID'] >= 80), 'STOCHRSIVOTE'] = -1
-        df.loc[(df['STOCHRSIK'] <= 20) & (df['STOCHRSID'] <= 20), 'STOCHRSIVOTE'] = 1
-
-        # TRIX Votes
-        df['TRIXVOTE'] = 0
-        df.loc[df['TRIX30'] > 0, 'TRIXVOTE'] = 1
-        df.loc[df['TRIX30'] < 0, 'TRIXVOTE'] = -1
-
-        # ULTOSC Votes
-        # I'm skipping this oscillator because the buy/sell conditions are three-pronged and not clear
-
-        # ADOSC Votes
-        df['ADOSCVOTE'] = 0
-        df.loc[df['ADOSC'] > 0, 'ADOSCVOTE'] = 1
-        df.loc[df['ADOSC'] < 0, 'ADOSCVOTE'] = -1
+        # Votes; when numba is installed the compiled kernel casts them all in one pass
+        if _votes_kernel is not None:
+            votes = _votes_kernel(*(df[x].to_numpy() for x in ['AROONOSC', 'BOP', 'CCI14', 'CMO14', 'MACDHIST', 'RSI14',
+                                                               'STOCHK', 'STOCHD', 'STOCHRSIK', 'STOCHRSID', 'TRIX30', 'ADOSC']))
+            for i, name in enumerate(VOTE_COLS):
+                df[name] = votes[:, i]
+        else:
+            aroonosc = df['AROONOSC'].to_numpy()
+            df['AROONVOTE'] = np.select([aroonosc >= 25, aroonosc <= -25], [1, -1], 0).astype(np.int8)  # These thresholds are a guess
+
+            # BOP Signal
+            bop = df['BOP'].to_numpy()
+            df['BOPVOTE'] = np.select([bop > 0, bop < 0], [1, -1], 0).astype(np.int8)
+
+            # CCI Vote
+            cci = df['CCI14'].to_numpy()
+            df['CCIVOTE'] = np.select([cci >= 100, cci <= -100], [1, -1], 0).astype(np.int8)
+
+            # CMO Votes
+            cmo = df['CMO14'].to_numpy()
+            df['CMOVOTE'] = np.select([cmo < -50, cmo > 50], [1, -1], 0).astype(np.int8)
+
+            # MACD Vote; based on when the histogram crosses the zero line
+            macdhist = df['MACDHIST'].to_numpy()
+            nextmacd = np.empty_like(macdhist)
+            nextmacd[:-1] = macdhist[1:]
+            nextmacd[-1:] = np.nan
+            df['MACDVOTE'] = np.select([(macdhist > 0) & (nextmacd < macdhist),
+                                        (macdhist < 0) & (nextmacd > macdhist)], [1, -1], 0).astype(np.int8)
+
+            # MFI Votes
+            # Skipping interpretting MFI because it correlates to the direction of price
+
+            # MOM Votes
+            # Skipping basic momentum because it's not a good signal for buy or sell
+
+            # PPO Votes; cousin of MACD
+            df['PPOVOTE'] = np.zeros(len(df), dtype=np.int8)
+            #df.loc[df['PPO12'] >= 0, 'RSIVOTE'] = 1
+            #df.loc[df['PPO12'] <= 0, 'RSIVOTE'] = -1
+
+            # ROC Votes
+            # Not using ROC because it's prone to whipsaws near the 0 line; and, this isn't used to trade
+
+            # RSI Votes
+            rsi = df['RSI14'].to_numpy()
+            df['RSIVOTE'] = np.select([rsi <= 30, rsi >= 70], [1, -1], 0).astype(np.int8)
+
+            # STOCH Votes
+            stochk = df['STOCHK'].to_numpy()
+            stochd = df['STOCHD'].to_numpy()
+            df['STOCHVOTE'] = np.select([(stochk <= 20) & (stochd <= 20), (stochk >= 80) & (stochd >= 80)],
+                                        [1, -1], 0).astype(np.int8)
+
+            # STOCHRSI Votes
+            stochrsik = df['STOCHRSIK'].to_numpy()
+            stochrsid = df['STOCHRSID'].to_numpy()
+            df['STOCHRSIVOTE'] = np.select([(stochrsik <= 20) & (stochrsid <= 20), (stochrsik >= 80) & (stochrsid >= 80)],
+                                           [1, -1], 0).astype(np.int8)
+
+            # TRIX Votes
+            trix = df['TRIX30'].to_numpy()
+            df['TRIXVOTE'] = np.select([trix > 0, trix < 0], [1, -1], 0).astype(np.int8)
+
+            # ULTOSC Votes
+            # I'm skipping this oscillator because the buy/sell conditions are three-pronged and not clear
+
+            # ADOSC Votes
+            adosc = df['ADOSC'].to_numpy()
+            df['ADOSCVOTE'] = np.select([adosc > 0, adosc < 0], [1, -1], 0).astype(np.int8)
 
         # Drop rows where there isn't enough information to vote
         # Note 1:  TRIX30 should be cleaned up, but the period is too long and it removes too much data.
         # Note 2:  MACD has a long period as well and will essentially eliminate trading before 10:00 AM
-        df.dropna(subset=['AROONUP', 'AROONDN', 'BOP', 'CCI14', 'CMO14', 'MACDHIST', 'PPO12', 'RSI14', 'STOCHK', 'STOCHD', 'STOCHRSIK', 'STOCHRSID', 'ADOSC'], inplace=True)
-
-        for x in df.index:
-            #print (df.loc[x, 'STRATEGY_ID'][0])
-            a = chr(66 + df.loc[x, 'AROONVOTE'])
-            b = chr(66 + df.loc[x, 'BOPVOTE'])
-            c = chr(66 + df.loc[x, 'CCIVOTE'])
-            d = chr(66 + df.loc[x, 'CMOVOTE'])
-            e = chr(66 + df.loc[x, 'MACDVOTE'])
-            f = chr(66 + df.loc[x, 'PPOVOTE'])
-            g = chr(66 + df.loc[x, 'RSIVOTE'])
-            h = chr(66 + df.loc[x, 'STOCHVOTE'])
-            i = chr(66 + df.loc[x, 'STOCHRSIVOTE'])
-            j = chr(66 + df.loc[x, 'TRIXVOTE'])
-            k = chr(66 + df.loc[x, 'ADOSCVOTE'])
-            df.loc[x, 'STRATEGY_ID'] = a + b + c + d + e + f + g + h +i + j + k
+        df.dropna(subset=VOTE_INPUTS, inplace=True)
+
+        # Build the strategy id from the votes; each vote (-1, 0, 1) maps to a letter ('A', 'B', 'C')
+        # The vote matrix is shifted to ASCII and its rows are read back as fixed-width byte strings
+        chars = df[VOTE_COLS].to_numpy(dtype=np.int8) + np.int8(66)
+        df['STRATEGY_ID'] = np.frombuffer(chars.view(np.uint8).tobytes(), dtype='S' + str(len(VOTE_COLS))) \
+                              .astype('U' + str(len(VOTE_COLS)))
+
+        # Store the indicators as float32 (half the memory) now that the trends and votes are decided
+        # Note:  Downcasting before the votes can round a value onto a threshold, e.g. a CCI of 99.999998 to 100.0
+        for name in [x for x, values in indicators.items() if values.dtype == np.float64] + ['AROONOSC']:
+            df[name] = df[name].astype(np.float32)
 
         return df
 
+def calcind_polars(df_pl, compute_all=True, dropna=True):
+    # Polars version of calcind; takes a LazyFrame (or DataFrame) with OHLCV columns and returns a DataFrame
+    # with the same indicator, vote and STRATEGY_ID columns.  Returns None if there is no data.
+    # Note:  Set dropna to False to keep the rows that can't vote (calcind drops them itself)
+    if isinstance(df_pl, pl.LazyFrame):
+        df_pl = df_pl.collect()
+    if df_pl.height == 0:
+        return None
+
+    # TA-Lib still does the math; feed it the OHLCV columns as contiguous float64 arrays
+    o, h, l, c, v = (np.ascontiguousarray(df_pl[x].cast(pl.Float64).to_numpy(), dtype=np.float64) for x in 'ohlcv')
+    indicators = [pl.Series(name, values, nan_to_null=True)
+                  for name, values in _calcta(o, h, l, c, v, compute_all).items()]
+    floats = [x.name for x in indicators if x.dtype == pl.Float64] + ['AROONOSC']
+
+    def vote(name, buy, sell):
+        return pl.when(buy).then(1).when(sell).then(-1).otherwise(0).cast(pl.Int8).alias(name)
+
+    def trend(name, col):
+        return pl.when(pl.col(col) >= 75).then(pl.lit('Very Strong')) \
+                 .when(pl.col(col) >= 50).then(pl.lit('Strong')) \
+                 .when(pl.col(col) >= 25).then(pl.lit('Changing')) \
+                 .otherwise(pl.lit('Weak')).cast(pl.Categorical).alias(name)
+
+    def letter(col):
+        return pl.when(pl.col(col) == 1).then(pl.lit('C')).when(pl.col(col) == -1).then(pl.lit('A')).otherwise(pl.lit('B'))
+
+    aroonosc = pl.col('AROONDN') - pl.col('AROONUP')
+    macdhist = pl.col('MACDHIST')
+    stochk, stochd = pl.col('STOCHK'), pl.col('STOCHD')
+    stochrsik, stochrsid = pl.col('STOCHRSIK'), pl.col('STOCHRSID')
+
+    # Same thresholds as calcind; missing indicator values vote 0 and trend 'Weak'
+    lf = (
+        df_pl.lazy()
+        .with_columns(indicators)
+        .with_columns([
+            trend('ADXTREND', 'ADX14'),
+            trend('ADXRTREND', 'ADXR14'),
+            aroonosc.alias('AROONOSC'),
+            vote('AROONVOTE', aroonosc >= 25, aroonosc <= -25),
+            vote('BOPVOTE', pl.col('BOP') > 0, pl.col('BOP') < 0),
+            vote('CCIVOTE', pl.col('CCI14') >= 100, pl.col('CCI14') <= -100),
+            vote('CMOVOTE', pl.col('CMO14') < -50, pl.col('CMO14') > 50),
+            vote('MACDVOTE', (macdhist > 0) & (macdhist.shift(-1) < macdhist),
+                 (macdhist < 0) & (macdhist.shift(-1) > macdhist)),
+            pl.lit(0, dtype=pl.Int8).alias('PPOVOTE'),
+            vote('RSIVOTE', pl.col('RSI14') <= 30, pl.col('RSI14') >= 70),
+            vote('STOCHVOTE', (stochk <= 20) & (stochd <= 20), (stochk >= 80) & (stochd >= 80)),
+            vote('STOCHRSIVOTE', (stochrsik <= 20) & (stochrsid <= 20), (stochrsik >= 80) & (stochrsid >= 80)),
+            vote('TRIXVOTE', pl.col('TRIX30') > 0, pl.col('TRIX30') < 0),
+            vote('ADOSCVOTE', pl.col('ADOSC') > 0, pl.col('ADOSC') < 0),
+        ])
+    )
+    if dropna:
+        lf = lf.drop_nulls(subset=VOTE_INPUTS)
+    return (
+        lf.with_columns(pl.concat_str([letter(x) for x in VOTE_COLS]).alias('STRATEGY_ID'))
+        .with_columns(pl.col(floats).cast(pl.Float32))
+        .collect()
+    )
+
+def calcind_batch(dfs, compute_all=True, n_workers=None):
+    # Run calcind over many independent stocks in parallel processes
+    # Takes and returns {ticker: dataframe}; each process handles up to 4 stocks at a time
+    # Note:  On Windows the worker processes re-import the calling script, so only call this from code that is
+    #        guarded by if __name__ == '__main__'
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as ex:
+        results = ex.map(partial(calcind, compute_all=compute_all), dfs.values(), chunksize=4)
+        return dict(zip(dfs.keys(), results))
+
 def InitSignal(tickers, families):
     # initialize a matrix of tickers x signal families
     sigarray = {}
@@ -263,27 +487,41 @@ def InitSignal(tickers, families):
         sigarray[t] = {f:0 for f in families}
     return sigarray
 
+def _alpaca():
+    # Build the Alpaca client once so its HTTP session (and open connections) are reused
+    global _ALPACA
+    if _ALPACA is None:
+        _ALPACA = tradeapi.REST()
+    return _ALPACA
+
+def _clock():
+    # Get the market clock; back-to-back checks within CLOCK_TTL seconds share one API call
+    global _CLOCK, _CLOCK_TIME
+    if _CLOCK is None or time.monotonic() - _CLOCK_TIME > CLOCK_TTL:
+        _CLOCK = _alpaca().get_clock()
+        _CLOCK_TIME = time.monotonic()
+    return _CLOCK
+
 def IsOpen():
     # check if the market is open
-    alpaca = tradeapi.REST()
-    clock = alpaca.get_clock()
+    clock = _clock()
     return clock.is_open
 
 def IsEOD(minutes=75):
     # check if we're at the end of the day
-    alpaca = tradeapi.REST()
-    clock = alpaca.get_clock()
-    delta = clock.next_close - clock.timestamp
-    if int(delta.total_seconds()/60) <= minutes:
-        return True
-    else:
-        return False
+    return SecondsToEOD(minutes) <= 0
+
+def SecondsToEOD(minutes=75):
+    # Seconds until IsEOD(minutes) is true; only whole minutes to the close count, so that's once fewer
+    # than minutes + 1 remain
+    # Note:  The age of a cached clock is taken off so the result doesn't run late
+    clock = _clock()
+    delta = clock.next_close - timedelta(minutes=minutes + 1) - clock.timestamp
+    return delta.total_seconds() - (time.monotonic() - _CLOCK_TIME)
 
 def roundTime(dt=None):
     # round the seconds off the time so we can time things to the beginning of the minute
-    if dt == None : dt = datetime.now()
-    format_str = '%Y-%m-%d %H:%M'
-    return datetime.strptime(datetime.strftime(dt, format_str), format_str)
+    return (dt or datetime.now()).replace(second=0, microsecond=0)
 
 def WaitForMinute():
     # Wait until the beginning of the next minute.
@@ -293,16 +531,17 @@ def WaitForMinute():
     time.sleep(waittime.seconds + 1) # Adding one second to eliminate ms variances
 
 def GetAccount():
-    # Get Alpaca account details
+    # Get Alpaca account details; repeat calls within ACCOUNT_TTL seconds reuse the last response
     # Note:  'buying_power' loans / credit are against the trading plan; only use cash
-    data = {}
-    alpaca = tradeapi.REST()
-    account = alpaca.get_account()
-    return account
+    global _ACCOUNT, _ACCOUNT_TIME
+    if _ACCOUNT is None or time.monotonic() - _ACCOUNT_TIME > ACCOUNT_TTL:
+        _ACCOUNT = _alpaca().get_account()
+        _ACCOUNT_TIME = time.monotonic()
+    return _ACCOUNT
 
 def GetOrders(status='open', startdate=None):
     # get orders of the defined type
-    alpaca = tradeapi.REST()
+    alpaca = _alpaca()
     if startdate != None:
         today_str = startdate
     else:
@@ -311,23 +550,75 @@ def GetOrders(status='open', startdate=None):
 
 def GetPositions():
     # get orders of the defined type
-    alpaca = tradeapi.REST()
+    alpaca = _alpaca()
     today_str = datetime.utcnow().strftime('%Y-%m-%d')
     return alpaca.list_positions()
 
+async def _ontradeupdate(data):
+    # Fills carry the position quantity after the fill; zero means the position was closed
+    if data.event in ('fill', 'partial_fill'):
+        symbol = data.order['symbol']
+        with _HELD_LOCK:
+            if float(data.position_qty) != 0:
+                _HELD.add(symbol)
+            else:
+                _HELD.discard(symbol)
+
+def _seedheld():
+    # Replace the tracked positions with the ones Alpaca reports now
+    global _HELD, _HELD_TIME
+    held = {p.symbol for p in GetPositions()}
+    with _HELD_LOCK:
+        _HELD = held
+        _HELD_TIME = time.monotonic()
+
+def _runstream(stream):
+    # Stream.run needs an asyncio event loop, and only the main thread gets one by default
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    try:
+        stream.run()
+        logging.warning('Trade updates stream stopped; positions will be counted through the API.')
+    except Exception:
+        logging.error('Trade updates stream failed; positions will be counted through the API.', exc_info=True)
+
+def StartTradeUpdates():
+    # Track held positions from Alpaca's trade updates stream so GetOrderCount doesn't need an API call
+    # Note:  The stream runs on a daemon thread; it's seeded from the current positions, which GetOrderCount
+    #        checks again every HELD_RESYNC seconds in case fills were missed (e.g. while the stream reconnected)
+    global _STREAM_THREAD
+    if _STREAM_THREAD is not None and _STREAM_THREAD.is_alive():
+        return
+    stream = tradeapi.Stream()
+    stream.subscribe_trade_updates(_ontradeupdate)
+    _seedheld()
+    _STREAM_THREAD = threading.Thread(target=_runstream, args=(stream,), name='trade-updates', daemon=True)
+    _STREAM_THREAD.start()
+    logging.info('Trade updates stream started; tracking ' + str(len(_HELD)) + ' held positions.')
+
 def GetOrderCount():
     # Get the number of position waiting to be sold and pending orders
+    # Use the positions tracked by the trade updates stream while it's running
+    if _STREAM_THREAD is not None and _STREAM_THREAD.is_alive():
+        if time.monotonic() - _HELD_TIME > HELD_RESYNC:
+            _seedheld()
+        with _HELD_LOCK:
+            return len(_HELD)
     heldstocks = len(GetPositions())
     #pendingstocks = len(GetOrders()) # I dont' think this will occur
     return int(int(heldstocks))
 
-def GetLastOpenMarket():
-    today = datetime.utcnow()
+@lru_cache(maxsize=1)
+def _lastopenmarket(today_str):
+    # The calendar only changes once a day, so it's fetched once per UTC date
+    today = parse(today_str)
     startdate = today - timedelta(days=14)
-    alpaca = tradeapi.REST()
-    cal = alpaca.get_calendar(start=startdate.strftime('%Y-%m-%d'), end=today.strftime('%Y-%m-%d'))
+    alpaca = _alpaca()
+    cal = alpaca.get_calendar(start=startdate.strftime('%Y-%m-%d'), end=today_str)
     return cal[-1].date.strftime('%Y-%m-%d')
 
+def GetLastOpenMarket():
+    return _lastopenmarket(datetime.utcnow().strftime('%Y-%m-%d'))
+
 def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='2020-01-21'):
     # Gets single stock data from Alpaca given the specified date
 
@@ -345,8 +636,8 @@ def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='20
 
     logging.info('Getting ' + timeframe + ' for ' + ticker + ' on ' + startdate)
 
-    # Initialize the Alpaca API
-    alpaca = tradeapi.REST()
+    # Get the shared Alpaca client; its HTTP session is reused across calls and retries
+    alpaca = _alpaca()
 
     # Put date strings into usable formats
     if timeframe == '1Min':
@@ -359,17 +650,21 @@ def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='20
         s = str(startdate.strftime("%Y-%m-%d"))
         e = str(enddate.strftime("%Y-%m-%d"))
 
-    # get the stock data for the current stock
+    # get the stock data for the current stock; back off 0.5, 1, 2, 4, 8 seconds (plus jitter) between attempts
     barset = None
-    while barset == None:
+    for attempt in range(1, BARSET_TRIES + 1):
         try:
             barset = alpaca.get_barset(ticker, timeframe=timeframe, limit=1000,
                                        start=pd.Timestamp(s, tz='America/New_York').isoformat(),
                                        end=pd.Timestamp(e, tz='America/New_York').isoformat())
-
+            break
         except Exception as ex:
-            logging.warning('Could not get barset data; retrying # in 10 seconds', exc_info=True)
-            time.sleep(10)
+            if attempt == BARSET_TRIES:
+                logging.error('Could not get barset data for ' + ticker + ' after ' + str(attempt) + ' attempts')
+                raise
+            delay = min(8, 0.5 * 2 ** (attempt - 1)) + random.random() * 0.25
+            logging.warning('Could not get barset data; retry #' + str(attempt) + ' in ' + str(round(delay, 2)) + ' seconds', exc_info=True)
+            time.sleep(delay)
 
     # Initialize working data structures
     df = {}
@@ -381,19 +676,29 @@ def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='20
         bars = barset[stock]
 
         logging.debug('Converting bar data for ' + stock)
-        data = {'ticker': [stock for bar in bars],
-                't': [bar.t for bar in bars],
-                'h': [bar.h for bar in bars],
-                'l': [bar.l for bar in bars],
-                'o': [bar.o for bar in bars],
-                'c': [bar.c for bar in bars],
-                'v': [bar.v for bar in bars]}
 
-        # copy the raw data before doing anything else to it
-        raw[stock] = pd.DataFrame(data)
+        # copy the raw data before doing anything else to it; one pass over the bars
+        raw[stock] = pd.DataFrame.from_records(
+            ((stock, bar.t, bar.h, bar.l, bar.o, bar.c, bar.v) for bar in bars),
+            columns=['ticker', 't', 'h', 'l', 'o', 'c', 'v']
+        ).astype({'h': 'float64', 'l': 'float64', 'o': 'float64', 'c': 'float64', 'v': 'int64'})
 
     return raw[stock]
 
+def GetOHLCVBatch(tickers, timeframe='1Min', startdate='1971-01-21', enddate='2020-01-21', n_workers=16):
+    # Gets data for several stocks at once; the requests are network-bound so they run on a thread pool
+    # Returns {ticker: dataframe}; stocks that could not be retrieved are logged and left out
+    data = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as ex:
+        futures = {ex.submit(GetOHLCV, ticker=t, timeframe=timeframe, startdate=startdate, enddate=enddate): t
+                   for t in tickers}
+        for fut in as_completed(futures):
+            try:
+                data[futures[fut]] = fut.result()
+            except Exception:
+                logging.warning('Could not get ' + timeframe + ' data for ' + futures[fut], exc_info=True)
+    return data
+
 def WriteOHLCV(df=None, timeframe='1Min'):
     # Writes stock data to SQL Server and disk
 
@@ -410,8 +715,10 @@ def WriteOHLCV(df=None, timeframe='1Min'):
         datefmt='%Y-%m-%d %H:%M:%S',
         level=os.environ.get("LOGLEVEL", "INFO"))
 
-    # Setup the cursor for SQL Server
+    # Setup the cursor for SQL Server; send parameter batches in bulk
     crs = sqldbcursor()
+    if crs is not None:
+        crs.fast_executemany = True
 
     # set the destination table
     tn = None
@@ -420,58 +727,48 @@ def WriteOHLCV(df=None, timeframe='1Min'):
     else:
         tn = 'ohlcv_day'
 
-    # delete the data from SQL Server
-    qry = "DELETE FROM stockdata.." + tn + " WHERE "
-    first=True
-    for index, row in df.iterrows():
-        # Add OR at the end if this isn't the first time in the loop
-        if first:
-            first = False
-        else:
-            qry = qry + ' or '
+    # format the timestamps once for both the delete and insert queries
+    tickers = df['ticker'].tolist()
+    t_date = df['t'].dt.strftime('%Y-%m-%d').tolist()
+    t_min = df['t'].dt.strftime('%Y-%m-%d %H:%M').tolist()
+    t_full = (df['t'].dt.strftime('%Y-%m-%d %H:%M:%S') + '-5:00').tolist()
 
-        # use the right keys in the WHERE clause
-        if timeframe == '1Min':
-            qry = qry + "(ticker = '" + row['ticker'] + "' AND t = '" + str(row['t'].strftime("%Y-%m-%d %H:%M%S")) + "-5:00')"
-        else:
-            qry = qry + "(ticker = '" + row['ticker'] + "' AND tradedate = '" + str(row['t'].strftime("%Y-%m-%d")) + "')"
+    # delete the data from SQL Server using the right keys for the timeframe
+    if timeframe == '1Min':
+        qry = "DELETE FROM stockdata.." + tn + " WHERE ticker = ? AND t = ?"
+        keys = list(zip(tickers, t_full))
+    else:
+        qry = "DELETE FROM stockdata.." + tn + " WHERE ticker = ? AND tradedate = ?"
+        keys = list(zip(tickers, t_date))
 
     # Execute the delete query
     try:
-        crs.execute(qry)
+        crs.executemany(qry, keys)
     except Exception as ex:
         logging.error(qry, exc_info=True)
 
-    # Write the data to SQL Server in one transaction
-    qry = "INSERT INTO stockdata.." + tn + " (ticker, tradedate, tradedatetime, t, o, h, l, c, v, stage) VALUES "
-    first=True
-    for index, row in df.iterrows():
-    # Write to SQL via INSERT or UPDATE, depending if the row exists or not
-        if first:
-            first = False
-        else:
-            qry = qry + ', '
-
-        # Add the value
-        qry = qry + "('" + str(row['ticker']) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d")) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d %H:%M")) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d %H:%M%S")) + "-5:00'" \
-                    ", '" + str(row['o']) + "'" \
-                    ", '" + str(row['h']) + "'" \
-                    ", '" + str(row['l']) + "'" \
-                    ", '" + str(row['c']) + "'" \
-                    ", '" + str(row['v']) + "'" \
-                    ", 'Ouro')"
+    # Write the data to SQL Server in one batch
+    qry = "INSERT INTO stockdata.." + tn + " (ticker, tradedate, tradedatetime, t, o, h, l, c, v, stage) " \
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'Ouro')"
+    rows = list(zip(tickers,
+                    t_date,
+                    t_min,
+                    t_full,
+                    df['o'].tolist(),
+                    df['h'].tolist(),
+                    df['l'].tolist(),
+                    df['c'].tolist(),
+                    df['v'].tolist()))
 
     # Execute the query
     try:
-        crs.execute(qry)
+        crs.executemany(qry, rows)
     except Exception as ex:
         logging.error(qry, exc_info=True)
 
-    with open (outpath, 'a', newline='\n', encoding='utf-8') as outfile:
-        df.to_csv(outfile, header=False, index=False)
+    # Append the rows to the day's file; pandas writes the encoded bytes directly to the binary handle
+    with open (outpath, 'ab') as outfile:
+        df.to_csv(outfile, header=False, index=False, encoding='utf-8', lineterminator='\n')
 
 
 
@@ -223,7 +223,7 @@ while (marketopen) or cmdline.test is True:
 
             # Calculate technical indicators
             logging.debug('Calculating technical indicators ' + stock)
-            df[stock] = ol.calcind(pd.DataFrame(data))
+            df[stock] = ol.calcind(pd.DataFrame(data), compute_all=False)
 
             # Find the recent high and low price
             logging.debug('Calculating recent high and low for ' + stock)
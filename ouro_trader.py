@@ -5,16 +5,25 @@
 
 # Required modules
 import ouro_lib as ol
-import json                             # for manipulating array data
+import orjson                           # fast json encoding and decoding
 import os                               # for basic OS functions
 import pandas as pd                     # in-memory database capabilities
+import numpy as np
 import argparse
-from progress.bar import Bar
+from tqdm import tqdm                   # for progress bars
+import sys
 import datetime                         # used for stock timestamps
 import alpaca_trade_api as tradeapi     # required for interaction with Alpaca
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from numba import njit              # optional JIT for the buy decisions
+except ImportError:
+    njit = None
 
 # Get Quorum path from environment
 quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
@@ -35,10 +44,16 @@ logging.basicConfig(
 logging.info('OURO-TRADER logging enabled.')
 
 # initialize files
+# Note:  The status file stays open for the day; each minute's decisions are appended to it
 try:
     logging.debug('Initializing trader files.')
-    with open (statuspath, 'w', newline='\n', encoding='utf-8') as outfile:
-        outfile.write('')
+    fieldnames = ['DateTime', 'Ticker', 'Cash', 'TradeCapital', 'BuyPrice', 'BuyLimit', 'MaxRiskAmt',
+                  'TradeRiskAmt', 'TradeRiskPct', 'PortfolioRiskPct', 'RiskPct', 'FamilyReturnPct', 'TradeReturnPct', 'OrderShares', 'RecentHigh',
+                  'RecentLow','FloorPrice', 'CeilingPrice', 'Decision', 'Reason']
+    statusfile = open(statuspath, 'w', newline='', encoding='utf-8', buffering=1 << 20)
+    statuswriter = csv.DictWriter(statusfile, fieldnames=fieldnames)
+    statuswriter.writeheader()
+    statusfile.flush()
     with open (buyskippath, 'w', newline='\n', encoding='utf-8') as outfile:
         outfile.write('')
 except Exception:
@@ -53,7 +68,11 @@ cmdline = parser.parse_args()
 logging.info('Command line arguement; test mode is ' + str(cmdline.test))
 
 # Initialize the Alpaca API
+# Note:  The client's requests session gets a pool big enough for the order threads so connections (and their
+#        TLS handshakes) are reused.  Only failed connects are retried so an order is never posted twice.
 alpaca = tradeapi.REST()
+alpaca._session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                              max_retries=Retry(connect=3, read=0, status=0, backoff_factor=0.1)))
 
 # Read the buy and sell strategies
 strategies = pd.read_csv(installpath + '\\buy_strategies.csv')
@@ -62,29 +81,86 @@ strategies = pd.read_csv(installpath + '\\buy_strategies.csv')
 familyreturns = {}
 try:
     logging.debug('Building strategy families and average return percentages')
-    for x in strategies['Family'].keys():
-        familyreturns[strategies.at[x, 'Family']] = strategies.at[x, 'AvgPctRtn']
+    familyreturns = dict(zip(strategies['Family'].tolist(), strategies['AvgPctRtn'].astype(float).tolist()))
 except Exception:
     logging.error('Could not build strategies', exc_info=True)
 
+# Pricing multipliers only depend on the family:  (expected return, floor percent, ceiling multiplier)
+# Note:  It's rare that the average is ever filled, so the expected return is 80% of it
+family_params = {fam: (ret * .8, ret * .8 * .5, 1 + ret) for fam, ret in familyreturns.items()}
 
 # Set maximum risk ratio to 0.5% of the account
 # This ratio cannot be exceeded on a single trade
 maxriskratio = .004
 
-# Initialize the stock lists
-boughtlist = []
-skiplist = []
-status = {}
-closeprices = {}
+# Reasons a stock is skipped, by the code the decision gives it
+SKIPREASONS = np.array(['Unknown', 'Unknown strategy family', 'Risk outweighs reward',
+                        'The potential return has already been met today.', 'Proposed stop-loss price already hit today',
+                        'Stock is too expensive or unable to buy shares.'])
+
+if njit is not None:
+    @njit(cache=True, error_model='numpy')
+    def _decide_kernel(stockprice, recenthigh, recentlow, yesterdayclose, familyret, floorpct, ceilingmult, oscillator,
+                       tradecapital, maxriskamt):
+        # Compiled version of the buy decision; one pass over the stocks with the same pricing and checks
+        # Returns the order shares, bracket prices, risk and return for each stock and its SKIPREASONS code
+        n = stockprice.shape[0]
+        ordershares = np.zeros(n, dtype=np.int64)
+        floorprice = np.empty(n)
+        ceilingprice = np.empty(n)
+        buylimit = np.empty(n)
+        traderiskamt = np.empty(n)
+        traderiskpct = np.empty(n)
+        traderet = np.empty(n)
+        skipcode = np.zeros(n, dtype=np.int64)
+        for i in range(n):
+            price = stockprice[i]
+            shares = np.int64(np.floor(tradecapital / price))
+            floor = price * (1 - floorpct[i])
+            ceiling = price * ceilingmult[i]
+            code = 0
+            if oscillator[i]:
+                if ceiling > recenthigh[i]:
+                    ceiling = recenthigh[i] - 0.05
+                if floor > recentlow[i]:
+                    shares = 0
+                    code = 4
+            if np.isnan(familyret[i]):
+                shares = 0
+            if price * shares * floorpct[i] > maxriskamt:
+                floor = price - ((ceiling - price) * .4)
+            traderiskamt[i] = (price - floor) * shares
+            traderiskpct[i] = (price - floor) / price
+            buylimit[i] = ((ceiling - price) * .05) + price
+            traderet[i] = (ceiling - buylimit[i]) / buylimit[i]
+            if (price - yesterdayclose[i]) / yesterdayclose[i] >= traderet[i]:
+                shares = 0
+                code = 3
+            if traderet[i] - .005 <= traderiskpct[i]:
+                shares = 0
+                code = 2
+            if np.isnan(familyret[i]):
+                code = 1
+            if shares == 0 and code == 0:
+                code = 5
+            ordershares[i] = shares
+            floorprice[i] = floor
+            ceilingprice[i] = ceiling
+            skipcode[i] = code
+        return ordershares, floorprice, ceilingprice, buylimit, traderiskamt, traderiskpct, traderet, skipcode
+else:
+    _decide_kernel = None
+
+# Initialize the stock lists; these are sets because they're checked for every inbound stock
+boughtlist = set()
+skiplist = set()
 
 # Get the closing prices for all the stocks from yesterday
+# Note:  They're converted to floats once here rather than every minute (SQL Server returns decimals)
 query = "select ticker, c from stockdata..ohlcv_day o " \
         "where tradedate in (select dateadd(day, -1, max(tradedate)) from stockdata..ohlcv_day)"
-crs = ol.sqldbcursor()
-crs.execute(query)
-for x in crs.fetchall():
-    closeprices[x[0]] = x[1]
+with ol.sqldbcursor() as crs:
+    closeprices = pd.Series(dict(crs.execute(query).fetchall()), dtype=np.float64)
 
 
 # Initialize MarketOpen
@@ -108,272 +184,226 @@ account = ol.GetAccount()
 cash = (float(account.buying_power) / (float(account.multiplier)))-25001 # minimum amount for day trading
 tradecapital = cash / 10
 
-while (marketopen and not eod) or cmdline.test is True:
-    marketopen = ol.IsOpen()
-    eod = ol.IsEOD()
+# Keep the held position count current from Alpaca's trade updates instead of asking for it every minute
+try:
+    ol.StartTradeUpdates()
+except Exception:
+    logging.error('Could not start the trade updates stream; positions will be counted through the API', exc_info=True)
+
+# set max trade risk; it's reduced to 30% while bandwagonning
+base_risk_normal = cash * maxriskratio
+base_risk_band = base_risk_normal * .3
 
+while (marketopen and not eod) or cmdline.test is True:
     # Log info for heartbeat
     logging.info('Checking inbound stock actions.')
 
-    # get ticker actions
-    with open(actionpath, 'r', encoding='utf-8') as infile:
-        inboundactions = json.load(infile)
+    # decisions made this minute; they're appended to the status file at the end of the minute
+    # Note:  Skipped stocks are logged together in one line at the end of the minute
+    status = {}
+    skipped = []
+
+    # get ticker actions; read the whole file in one go and decode it with orjson
+    with open(actionpath, 'rb', buffering=1 << 20) as infile:
+        inboundactions = orjson.loads(infile.read())
 
-    #setup a progress bar
-    starttime = datetime.datetime.now().strftime('%H:%M:%S')
-    logtime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    prgbar = Bar('  Stocks ' + starttime + ': ', max=len(inboundactions))
+    # timestamps for the progress bar and status file
+    now = datetime.datetime.now()
+    starttime = now.strftime('%H:%M:%S')
+    logtime = now.strftime('%Y-%m-%d %H:%M:%S')
+
+    # Only stocks that haven't been bought or skipped are considered
+    newstocks = [stock for stock in inboundactions if stock not in boughtlist and stock not in skiplist]
 
     # Bandwagonning happens where trader gets out of sync with pathfinder
     # and there is an abundance of orders (>10) that need to be bought.
     # This script will submit buy orders faster than they can be executed
     # so they're never seen in order count.  This helps limit the effect
     # of bandwagonning.
-    inboundcount = 0
-    for stock in inboundactions:
-        if stock not in boughtlist and stock not in skiplist:
-            inboundcount += 1
-
-    # loop through the inbound stocks
-    for stock in inboundactions:
-        if inboundcount >= 10:
-            # Give the order execution engine time to catch up
-            time.sleep(2)
-            # Reduce the risk if bandwaggoning is happening
-            bandwagondiscount = .3
-            logging.debug('Bandwagonning detected; reducing risk and delaying order placement.')
+    inboundcount = len(newstocks)
+    if inboundcount >= 10:
+        # Reduce the risk if bandwaggoning is happening
+        maxriskamt = base_risk_band
+        logging.debug('Bandwagonning detected; reducing risk.')
+    else:
+        # This is normal; risk is not modified
+        maxriskamt = base_risk_normal
+
+    # Decide which stocks to buy; the pricing for every new stock is calculated at once with numpy
+    # and the orders are placed together afterwards
+    toorder = {}
+    # Note:  When every inbound stock has already been decided there's nothing to do this minute
+    if newstocks:
+        # Get the number of held positions once per minute; orders queued below are added to it
+        heldcount = ol.GetOrderCount()
+
+        actions = pd.DataFrame.from_dict({stock: inboundactions[stock] for stock in newstocks}, orient='index')
+        family = actions['strategyfamily']
+        # Note:  orjson already decodes the prices as floats, so no conversion is needed here
+        stockprice = actions['price'].to_numpy(np.float64)
+        recenthigh = actions['recenthigh'].to_numpy(np.float64)
+        recentlow = actions['recentlow'].to_numpy(np.float64)
+        yesterdayclose = actions.index.map(closeprices).to_numpy()
+
+        # Get the strategy family pricing; unknown families come through as NaN and are skipped
+        familyret, floorpct, ceilingmult = (family.map({fam: p[i] for fam, p in family_params.items()}).to_numpy(np.float64)
+                                            for i in range(3))
+        oscillator = (family != 'Candlestick').to_numpy()
+
+        if _decide_kernel is not None:
+            # when numba is installed the compiled kernel makes every decision in one pass
+            ordershares, floorprice, ceilingprice, buylimit, traderiskamt, traderiskpct, traderet, skipcode = _decide_kernel(
+                stockprice, recenthigh, recentlow, yesterdayclose, familyret, floorpct, ceilingmult, oscillator,
+                tradecapital, maxriskamt)
         else:
-            # This is normal; risk is not modified
-            bandwagondiscount = 1
-
-        if stock not in boughtlist and stock not in skiplist:
-            # how much is the stock
-            stockprice = float(inboundactions[stock].get('price'))
-            recenthigh = float(inboundactions[stock].get('recenthigh'))
-            recentlow = float(inboundactions[stock].get('recentlow'))
-            yesterdayclose = float(closeprices.get(stock))
-
-            # set max trade risk
-            maxriskamt = cash * maxriskratio * bandwagondiscount
-            traderiskamt = cash * maxriskratio * bandwagondiscount
-
-            # how much capital should I use on this trade?
-            ordercount = ol.GetOrderCount()
-            if ordercount < 10:
-                # tradecapital = cash / float(10-ordercount)
-                logging.debug('Orders are < 10; trade capital set to ' + str(tradecapital))
-            else:
-                # tradecapital = 0
-                logging.debug('Orders count is > 10; trade capital set to 0')
+            unknownfamily = np.isnan(familyret)
 
             # how many shares should I buy
-            ordershares = int(tradecapital/float(inboundactions[stock].get('price')))
-
-            # reset pricing
-            floorprice = 0
-            ceilingprice = 0
-            buylimit = 0
-            traderiskpct = 0
-            familyret = 0
-
-            if ordercount < 10:
-                # reset the skip reason
-                skipreason = 'Unknown'
-
-                # Get the strategy family and estimated return
-                family = inboundactions[stock].get('strategyfamily')
-                familyret = float(familyreturns[family]) * .8  # It's rare that the average is every filled
-
-                # Set the baseline floor price and percent based on the return rate
-                floorpct = familyret * .5
-                floorprice = stockprice * (1-floorpct)
-
-                # set the ceiling price for the bracket order
-                ceilingprice = stockprice * (1 + float(familyreturns[family]))
-
-                # Adjust prices to recent high/low if we're using oscilators
-                if family != 'Candlestick':
-                    # Pricing reality check -- are the prices achievable in the recent past?
-                    if ceilingprice > recenthigh:
-                        ceilingprice = recenthigh - 0.05  # $0.05 under the recent high
-                    if floorprice > recentlow:
-                        skipreason = 'Proposed stop-loss price already hit today'
-                        ordershares = 0
-
-                # Adjust the floor price if there is more risk than reward
-                if (stockprice * ordershares * floorpct) > maxriskamt:
-                    # Use 40% of the ceiling difference as the new floor amount
-                    floorprice = stockprice - ((ceilingprice-stockprice) * .4) # I never want to break even on risk
-
-                # Calculate the amount risked on this trade
-                traderiskamt = (stockprice - floorprice) * ordershares
-                traderiskpct = (stockprice - floorprice) / stockprice
-
-                # set the buy limit to 5% of the potential profit
-                buylimit = ((ceilingprice - stockprice) * .05) + stockprice
-
-                # Calculate the trade return
-                traderet = (ceilingprice - buylimit) / buylimit
-
-                # Check if the price change between now and yesterday's close is more than
-                # the average for this strategy family.
-                if (stockprice - yesterdayclose) / yesterdayclose >= traderet:
-                    ordershares = 0
-                    skipreason = 'The potential return has already been met today.'
-
-                # Are we planning on making more than we risk?
-                if traderet-.005 <= traderiskpct:
-                    # This is a bad trade
-                    ordershares = 0
-                    skipreason = 'Risk outweighs reward'
-
-                # place the order
-                if ordershares > 0:
-                    try:
-                        logging.debug('Placing a bracket order for' + stock)
-                        alpaca.submit_order(
-                            side='buy',
-                            symbol=stock,
-                            type='limit',
-                            limit_price=buylimit,
-                            qty=ordershares,
-                            time_in_force='day', # bracket order must be 'day' or 'gtc'
-                            order_class='bracket',
-                            take_profit={
-                                'limit_price': ceilingprice
-                            },
-                            stop_loss={
-                                'stop_price': floorprice
-                            }
-
-                        )
-                        # Add this to the stocks already bought
-                        # Note:  Only add this to the bought list if the placing the order was successful
-                        #        This allows the stock to be re-tried if the price falls below the stop
-                        #        point before the buy order can be filled.
-                        boughtlist.append(stock)
-                        status[stock] = {
-                            'DateTime': logtime,
-                            'Ticker': stock,
-                            'Cash': cash,
-                            'TradeCapital': tradecapital,
-                            'BuyPrice': stockprice,
-                            'BuyLimit': buylimit,
-                            'MaxRiskAmt': maxriskamt,
-                            'TradeRiskAmt': traderiskamt,
-                            'TradeRiskPct': traderiskpct,
-                            'PortfolioRiskPct': traderiskamt/cash,
-                            'FamilyReturnPct': familyret,
-                            'TradeReturnPct' : traderet,
-                            'OrderShares': ordershares,
-                            'RecentHigh': recenthigh,
-                            'RecentLow':  recentlow,
-                            'FloorPrice': floorprice,
-                            'CeilingPrice': ceilingprice,
-                            'Decision': 'buy',
-                            'Reason': family
-                        }
-                    except Exception as ex:
-                        logging.error('Could not submit buy order', exc_info=True)
-                        logging.info('Skipping ' + stock + ' because buy order failed.')
-                        if stock not in skiplist:
-                            # add this to the skip list -- the timing just wasn't right
-                            # skiplist.append(stock) -- With buy limits, I don't need to do this.
-
-                            # Annotate what happened
-                            status[stock] = {
-                                'DateTime': logtime,
-                                'Ticker': stock,
-                                'Cash': cash,
-                                'TradeCapital': tradecapital,
-                                'BuyPrice': stockprice,
-                                'BuyLimit': buylimit,
-                                'MaxRiskAmt': maxriskamt,
-                                'TradeRiskAmt': traderiskamt,
-                                'TradeRiskPct': traderiskpct,
-                                'PortfolioRiskPct': traderiskamt / cash,
-                                'FamilyReturnPct': familyret,
-                                'TradeReturnPct': traderet,
-                                'OrderShares': ordershares,
-                                'RecentHigh': recenthigh,
-                                'RecentLow': recentlow,
-                                'FloorPrice': floorprice,
-                                'CeilingPrice': ceilingprice,
-                                'Decision': 'skip',
-                                'Reason': skipreason + ' - buy order failed; eligible for retry.'
-                            }
-                else:
-                    # define skipping reasons if not previously defined
-                    if ordershares == 0 and skipreason == 'Unknown':
-                        skipreason = 'Stock is too expensive or unable to buy shares.'
-                    if stock in boughtlist and skipreason == 'Unknown':
-                        skipreason = 'Stock in bought list.'
-                    if ordercount >= 10 and skipreason == 'Unknown':
-                        skipreason = 'Too many existing positions'
-
-                    logging.info('Skipping ' + stock)
+            ordershares = np.floor(tradecapital / stockprice).astype(np.int64)
+
+            # Set the baseline floor price based on the return rate and the ceiling price for the bracket order
+            floorprice = stockprice * (1 - floorpct)
+            ceilingprice = stockprice * ceilingmult
+
+            # Adjust prices to recent high/low if we're using oscilators
+            # Pricing reality check -- are the prices achievable in the recent past?
+            ceilingprice = np.where(oscillator & (ceilingprice > recenthigh), recenthigh - 0.05, ceilingprice)  # $0.05 under the recent high
+            stophit = oscillator & (floorprice > recentlow)
+            ordershares[stophit | unknownfamily] = 0
+
+            # Adjust the floor price if there is more risk than reward
+            # Use 40% of the ceiling difference as the new floor amount; I never want to break even on risk
+            floorprice = np.where(stockprice * ordershares * floorpct > maxriskamt,
+                                  stockprice - ((ceilingprice - stockprice) * .4), floorprice)
+
+            # Calculate the amount risked on this trade
+            traderiskamt = (stockprice - floorprice) * ordershares
+            traderiskpct = (stockprice - floorprice) / stockprice
+
+            # set the buy limit to 5% of the potential profit and calculate the trade return
+            buylimit = ((ceilingprice - stockprice) * .05) + stockprice
+            traderet = (ceilingprice - buylimit) / buylimit
+
+            # Check if the price change between now and yesterday's close is more than
+            # the average for this strategy family.
+            returnmet = (stockprice - yesterdayclose) / yesterdayclose >= traderet
+
+            # Are we planning on making more than we risk?
+            badtrade = traderet - .005 <= traderiskpct
+            ordershares[returnmet | badtrade] = 0
+
+            # The last check that failed is the reason for skipping
+            skipcode = np.select([unknownfamily, badtrade, returnmet, stophit, ordershares == 0], [1, 2, 3, 4, 5], 0)
+        skipreason = SKIPREASONS[skipcode]
+
+        # Orders queued ahead of a stock use up the open order slots; stocks past the limit of 10
+        # aren't decided and are checked again next minute
+        buying = ordershares > 0
+        decided = (np.cumsum(buying) - buying) < 10 - heldcount
+
+        # Record what was decided for the status file
+        decisions = pd.DataFrame({
+            'DateTime': logtime,
+            'Ticker': actions.index,
+            'Cash': cash,
+            'TradeCapital': tradecapital,
+            'BuyPrice': stockprice,
+            'BuyLimit': buylimit,
+            'MaxRiskAmt': maxriskamt,
+            'TradeRiskAmt': traderiskamt,
+            'TradeRiskPct': traderiskpct,
+            'PortfolioRiskPct': traderiskamt / cash,
+            'FamilyReturnPct': familyret,
+            'TradeReturnPct': traderet,
+            'OrderShares': ordershares,
+            'RecentHigh': recenthigh,
+            'RecentLow': recentlow,
+            'FloorPrice': floorprice,
+            'CeilingPrice': ceilingprice,
+            'Decision': 'buy',
+            'Reason': family.to_numpy()
+        })
+
+        # Note:  The progress bar only redraws every 5 seconds and is off when there's no terminal
+        prgbar = tqdm(decisions[decided].to_dict('records'), desc='  Stocks ' + starttime, mininterval=5,
+                      disable=not sys.stderr.isatty())
+        for decision, reason in zip(prgbar, skipreason[decided].tolist()):
+            stock = decision['Ticker']
+            if decision['OrderShares'] > 0:
+                # queue the order
+                order = {
+                    'side': 'buy',
+                    'symbol': stock,
+                    'type': 'limit',
+                    'limit_price': decision['BuyLimit'],
+                    'qty': decision['OrderShares'],
+                    'time_in_force': 'day',  # bracket order must be 'day' or 'gtc'
+                    'order_class': 'bracket',
+                    'take_profit': {
+                        'limit_price': decision['CeilingPrice']
+                    },
+                    'stop_loss': {
+                        'stop_price': decision['FloorPrice']
+                    }
+                }
+                toorder[stock] = (order, decision, reason)
+            else:
+                # add this to the skip list -- the timing just wasn't right
+                logging.debug('Skipping ' + stock)
+                skipped.append(stock)
+                skiplist.add(stock)
+                status[stock] = dict(decision, Decision='skip', Reason=reason + '; not eligible for retry.')
+
+    # Place the queued bracket orders in parallel; each one is a separate round trip to Alpaca
+    if toorder:
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            futures = {ex.submit(alpaca.submit_order, **order): stock for stock, (order, decision, skipreason) in toorder.items()}
+            for fut in as_completed(futures):
+                stock = futures[fut]
+                order, decision, skipreason = toorder[stock]
+                try:
+                    fut.result()
+                    # Add this to the stocks already bought
+                    # Note:  Only add this to the bought list if the placing the order was successful
+                    #        This allows the stock to be re-tried if the price falls below the stop
+                    #        point before the buy order can be filled.
+                    logging.debug('Placed a bracket order for ' + stock)
+                    boughtlist.add(stock)
+                    status[stock] = decision
+                except Exception:
+                    logging.error('Could not submit buy order', exc_info=True)
+                    logging.debug('Skipping ' + stock + ' because buy order failed.')
+                    skipped.append(stock)
                     if stock not in skiplist:
                         # add this to the skip list -- the timing just wasn't right
-                        skiplist.append(stock)
-                        status[stock] = {
-                            'DateTime': logtime,
-                            'Ticker': stock,
-                            'Cash': cash,
-                            'TradeCapital': tradecapital,
-                            'BuyPrice': stockprice,
-                            'BuyLimit': buylimit,
-                            'MaxRiskAmt': maxriskamt,
-                            'TradeRiskAmt': traderiskamt,
-                            'TradeRiskPct': traderiskpct,
-                            'PortfolioRiskPct': traderiskamt/cash,
-                            'FamilyReturnPct': familyret,
-                            'TradeReturnPct' : traderet,
-                            'OrderShares': ordershares,
-                            'RecentHigh': recenthigh,
-                            'RecentLow':  recentlow,
-                            'FloorPrice': floorprice,
-                            'CeilingPrice': ceilingprice,
-                            'Decision': 'skip',
-                            'Reason': skipreason + '; not eligible for retry.'
-                        }
-        # Update the order count after submitting the order
-        ordercount = ol.GetOrderCount()
-
-        #advance the progress bar
-        prgbar.next()
-
-    # finish the progress bar
-    prgbar.finish()
+                        # skiplist.add(stock) -- With buy limits, I don't need to do this.
+
+                        # Annotate what happened
+                        status[stock] = dict(decision, Decision='skip', Reason=skipreason + ' - buy order failed; eligible for retry.')
+
+    if skipped:
+        logging.info('Skipped ' + str(len(skipped)) + ' stocks:  ' + ', '.join(skipped))
 
     # write the bought and skip lists
     try:
         logging.debug('Writing bought and skip list.')
-        with open (buyskippath, 'w', newline='\n', encoding='utf-8') as outfile:
+        with open (buyskippath, 'wb', buffering=1 << 20) as outfile:
             tmp = {
-                'buy': boughtlist,
-                'skip': skiplist
+                'buy': list(boughtlist),
+                'skip': list(skiplist)
             }
-            tmp = json.dumps(status, indent=4)
-            outfile.write(tmp)
+            outfile.write(orjson.dumps(tmp, option=orjson.OPT_INDENT_2))
     except Exception:
         try:
             logging.error('Could not write buy and skip list', exc_info=True)
         except:
             print('Could not write to log file')
 
-    # update broker status
+    # append this minute's decisions to the broker status
     try:
         logging.debug('Writing broker status')
-        with open (statuspath, 'w', newline='\n', encoding='utf-8') as outfile:
-            fieldnames = ['DateTime', 'Ticker', 'Cash', 'TradeCapital', 'BuyPrice', 'BuyLimit', 'MaxRiskAmt',
-                          'TradeRiskAmt', 'TradeRiskPct', 'PortfolioRiskPct', 'RiskPct', 'FamilyReturnPct', 'TradeReturnPct', 'OrderShares', 'RecentHigh',
-                          'RecentLow','FloorPrice', 'CeilingPrice', 'Decision', 'Reason']
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            # write the header
-            writer.writeheader()
-            #writer.writerow(['datetime', 'ticker', 'cash', 'TradeRiskAmt', 'TradeCapital', 'OrderShares', 'FloorPrice', 'CeilingPrice', 'Decision'])
-            for x in status:
-                writer.writerow(status[x])
+        statuswriter.writerows(status.values())
+        statusfile.flush()
     except Exception:
         try:
             logging.error('Could not write broker status', exc_info=True)
@@ -382,21 +412,27 @@ while (marketopen and not eod) or cmdline.test is True:
 
 
     # wait until the next minute before checking again
+    # Note:  The market state is only refreshed here so it's checked once per minute
     ol.WaitForMinute()
+    marketopen, eod = ol.IsOpen(), ol.IsEOD()
+
+# No more decisions are made today
+statusfile.close()
 
 # Log the transition to end of day processing
 logging.info('Early end-of-day detected; checking for stocks that should be liquidated early.')
 
 # Get stocks that should be sold early
-try:
-    crs = ol.sqldbcursor()
-    query = "select ticker from stockdata..ticker_statistics where sellwhen = 'Early'"
-    se = crs.execute(query)
-    earlylist = []
-    for x in se.fetchall():
-        earlylist.append(x[0])
-except Exception as ex:
-    logging.error('Could not get list of early stocks.', exc_info=True)
+# Note:  This runs hours after startup on a new connection; it's tried a second time if the query fails
+earlyset = set()
+query = "select ticker from stockdata..ticker_statistics where sellwhen = 'Early'"
+for attempt in range(2):
+    try:
+        with ol.sqldbcursor() as crs:
+            earlyset = {x[0] for x in crs.execute(query).fetchall()}
+        break
+    except Exception as ex:
+        logging.error('Could not get list of early stocks.', exc_info=True)
 
 logging.info('15-minute end-of-day check:  ' + str(ol.IsEOD(minutes=15)))
 
@@ -407,25 +443,28 @@ if cmdline.marketopen:
 
 # Start wrapping up the day
 while (not eod):
-    # Check if a stock on an open order is in the early-sell list and cancel it
-    for stock in ol.GetOrders():
-        if stock.symbol in earlylist:
+    # The cancels and closes are separate round trips to Alpaca, so they're made in parallel
+    # Note:  Every cancel finishes before any position is closed; open orders hold the shares
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        # Check if a stock on an open order is in the early-sell list and cancel it
+        futures = {ex.submit(alpaca.cancel_order, stock.id): stock.symbol for stock in ol.GetOrders() if stock.symbol in earlyset}
+        for fut in as_completed(futures):
             try:
-                alpaca.cancel_order(stock.id)
-                logging.info('Cancelling open orders for ' + stock.symbol + ' early.')
-            except Exception as ex:
+                fut.result()
+                logging.info('Cancelling open orders for ' + futures[fut] + ' early.')
+            except Exception:
                 logging.error('Could not cancel order', exc_info=True)
-    # If a held position is in the early sell list, close it
-    for stock in ol.GetPositions():
-        if stock.symbol in earlylist:
+        # If a held position is in the early sell list, close it
+        futures = {ex.submit(alpaca.close_position, stock.symbol): stock.symbol for stock in ol.GetPositions() if stock.symbol in earlyset}
+        for fut in as_completed(futures):
             try:
-                alpaca.close_position(stock.symbol)
-                logging.info('Closing open positions for ' + stock.symbol + ' early.')
-            except Exception as ex:
+                fut.result()
+                logging.info('Closing open positions for ' + futures[fut] + ' early.')
+            except Exception:
                 logging.error('Could not close position', exc_info=True)
 
-    # Wait for a minute until we're 15 minutes before the end of the day
-    time.sleep(60)
+    # Wait for a minute, or less when we're closer than that to 15 minutes before the end of the day
+    time.sleep(min(max(1, ol.SecondsToEOD(minutes=15)), 60))
 
     # If forcing the market open, simulate the end of day
     eod = ol.IsEOD(minutes=15)
@@ -3,13 +3,16 @@ pip install datetime
 pip install dateutil
 pip install json
 pip install logging
+pip install orjson
 pip install os
+pip install numpy
 pip install pandas
 pip install pyodbc
 pip install time
 pip install yfinance
 pip install argparse
 pip install progress
+pip install tqdm
 pip install uuid
 
 pip install talib